@@ -1,19 +1,26 @@
 import pandas as pd
 import scipy.sparse as sparse
 import numpy as np
-import random
 import implicit
-from pandas.api.types import CategoricalDtype
-from sklearn import metrics
-from sklearn.preprocessing import MinMaxScaler, MaxAbsScaler
-
-from scipy.sparse.linalg import spsolve
+import numba
+from scipy.stats import rankdata
 
 # disable the chain_assigment warning
 pd.options.mode.chained_assignment = None  # default='warn'
 
+compare_with_implicit = False  # Set to True to also fit the model with the implicit library and compare AUCs
+
 website_url = 'http://archive.ics.uci.edu/ml/machine-learning-databases/00352/Online%20Retail.xlsx'
-retail_data = pd.read_excel('OnlineRetail.xlsx') # This may take a couple minutes
+try:
+    retail_data = pd.read_parquet('OnlineRetail.parquet') # Parsed copy of the spreadsheet saved by an earlier run
+except (FileNotFoundError, ImportError): # No cache yet, or no parquet engine (pyarrow/fastparquet) installed
+    retail_data = pd.read_excel('OnlineRetail.xlsx') # This may take a couple minutes
+    retail_data = retail_data.astype({'InvoiceNo': str, 'StockCode': str, 'Description': 'string'}) # These columns
+    # mix numbers and text, which parquet can't store
+    try:
+        retail_data.to_parquet('OnlineRetail.parquet', compression='lz4') # Cache it so later runs skip the slow parse
+    except ImportError:
+        pass # Without a parquet engine every run reads the spreadsheet, as before
 
 cleaned_retail = retail_data.loc[pd.isnull(retail_data.CustomerID) == False]
 cleaned_retail.info()
@@ -21,6 +28,8 @@ cleaned_retail.info()
 # look up table for future use
 item_lookup = cleaned_retail[['StockCode', 'Description']].drop_duplicates() # Only get unique item/description pairs
 item_lookup['StockCode'] = item_lookup.StockCode.astype(str) # Encode as strings for future lookup ease
+item_lookup_by_code = item_lookup.drop_duplicates('StockCode').set_index('StockCode') # One description per code,
+# indexed by the code so lookups are a hash instead of a scan of the whole table
 #print(item_lookup.head())
 
 #
@@ -29,25 +38,26 @@ cleaned_retail = cleaned_retail[['StockCode', 'Quantity', 'CustomerID']] # Get r
 
 # group data cleaned
 grouped_cleaned = cleaned_retail.groupby(['CustomerID', 'StockCode']).sum().reset_index() # Group together
-grouped_cleaned.Quantity.loc[grouped_cleaned.Quantity == 0] = 1 # Replace a sum of zero purchases with a one to
-# indicate purchased
-grouped_purchased = grouped_cleaned.query('Quantity > 0') # Only get customers where purchase totals were positive
+quantity_sums = grouped_cleaned.Quantity.to_numpy(copy=True)
+quantity_sums[quantity_sums == 0] = 1 # Replace a sum of zero purchases with a one to indicate purchased
+grouped_cleaned['Quantity'] = quantity_sums
+grouped_purchased = grouped_cleaned.loc[quantity_sums > 0] # Only get customers where purchase totals were positive
 print(grouped_purchased.head())
 
 
 # creating the user-item sparse rating matrix
-customers = list(np.sort(grouped_purchased.CustomerID.unique())) # Get our unique customers
-products = list(grouped_purchased.StockCode.unique()) # Get our unique products that were purchased
-quantity = list(grouped_purchased.Quantity) # All of our purchases
+customers_arr = np.sort(grouped_purchased.CustomerID.unique()) # Array of our unique customers
+products_arr = grouped_purchased.StockCode.unique() # Array of our unique products that were purchased
+quantity = grouped_purchased.Quantity.values # All of our purchases
 
 
-cus_type = CategoricalDtype(categories = customers)
-pro_type = CategoricalDtype(categories = products)
-rows = grouped_purchased.CustomerID.astype('category', cus_type).cat.codes
+rows = pd.Categorical(grouped_purchased.CustomerID, categories = customers_arr).codes
 # Get the associated row indices
-cols = grouped_purchased.StockCode.astype('category', pro_type).cat.codes
+cols = pd.Categorical(grouped_purchased.StockCode, categories = products_arr).codes
 # Get the associated column indices
-purchases_sparse = sparse.csr_matrix((quantity, (rows, cols)), shape=(len(customers), len(products)))
+purchases_sparse = sparse.csr_matrix((quantity, (rows, cols)), shape=(customers_arr.size, products_arr.size))
+purchases_sparse = purchases_sparse.astype(np.float32) # Single precision is plenty for ALS and halves the memory
+cust_to_idx = {cust: ind for ind, cust in enumerate(customers_arr)} # Row of the ratings matrix for each customer ID
 # what is inside
 print(purchases_sparse.shape)
 
@@ -84,24 +94,78 @@ def make_train(ratings, pct_test=0.2):
     This will be necessary later when evaluating the performance via AUC.
     '''
     test_set = ratings.copy()  # Make a copy of the original set to be the test set.
-    test_set[test_set != 0] = 1  # Store the test set as a binary preference matrix
     training_set = ratings.copy()  # Make a copy of the original data we can alter as our training set.
-    nonzero_inds = training_set.nonzero()  # Find the indices in the ratings data where an interaction exists
-    nonzero_pairs = list(zip(nonzero_inds[0], nonzero_inds[1]))  # Zip these pairs together of user,item index into list
-    random.seed(0)  # Set the random seed to zero for reproducibility
+    training_set.eliminate_zeros()  # Make sure every stored entry is an interaction that actually took place
+    rng = np.random.default_rng(0)  # Set the random seed to zero for reproducibility
     num_samples = int(
-        np.ceil(pct_test * len(nonzero_pairs)))  # Round the number of samples needed to the nearest integer
-    samples = random.sample(nonzero_pairs, num_samples)  # Sample a random number of user-item pairs without replacement
-    user_inds = [index[0] for index in samples]  # Get the user row indices
-    item_inds = [index[1] for index in samples]  # Get the item column indices
-    training_set[user_inds, item_inds] = 0  # Assign all of the randomly chosen user-item pairs to zero
+        np.ceil(pct_test * training_set.nnz))  # Round the number of samples needed to the nearest integer
+    samples = rng.choice(training_set.nnz, size=num_samples, replace=False)  # Sample positions in the stored data
+    # without replacement, each one is a user-item pair
+    user_inds = np.repeat(np.arange(training_set.shape[0]), np.diff(training_set.indptr))[samples]  # Get the user
+    # row of each sampled position
+    training_set.data[samples] = 0  # Assign all of the randomly chosen user-item pairs to zero
     training_set.eliminate_zeros()  # Get rid of zeros in sparse array storage after update to save space
-    return training_set, test_set, list(set(user_inds))  # Output the unique list of user rows that were altered
+    return training_set, test_set, np.unique(user_inds)  # Output the unique user rows that were altered
 
 product_train, product_test, product_users_altered = make_train(purchases_sparse, pct_test = 0.2)
 
 
-def implicit_weighted_ALS(training_set, lambda_val=0.1, alpha=40, iterations=10, rank_size=20, seed=0):
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def als_step(indptr, indices, data, Y, yTy_reg, alpha, cg_steps, X_out):
+    '''
+    One half of an ALS iteration: updates the feature vector of every row (every user, or every item) while the other
+    side's factors are held fixed. Compiled with numba, so everything runs without going back through Python, and the
+    rows are spread over all cores. Rather than solving the normal equations exactly, each row takes a few conjugate
+    gradient steps starting from its current vector (Takacs, Pilaszy, and Tikk 2011), which never builds the k x k
+    matrix and is nearly as accurate once the previous iterate is close.
+
+    parameters:
+
+    indptr, indices, data - The compressed arrays of the raw ratings matrix (csr when solving users, csc when solving
+    items), so each row's entries are one contiguous slice
+
+    Y - The fixed feature vectors of the other side, a dense ndarray with shape n x rank
+
+    yTy_reg - yTy + lambda*I, computed once per iteration
+
+    alpha - The confidence scaling, Cui = 1 + alpha*Rui
+
+    cg_steps - The number of conjugate gradient steps to take per row
+
+    X_out - The m x rank array of current feature vectors, used as the starting point
+
+    returns:
+
+    Nothing, the rows of X_out are updated in place.
+    '''
+    for u in numba.prange(indptr.size - 1):
+        x = X_out[u]
+        # Residual r = yTCuPu - (yTy + yT(Cu-I)Y + lambda*I)x, only the observed entries add to the sums since they
+        # are the only places Cu - I and pu are nonzero
+        r = -yTy_reg.dot(x)
+        for ptr in range(indptr[u], indptr[u + 1]):
+            y = Y[indices[ptr]]
+            cuI = alpha * data[ptr]
+            r += (cuI + 1 - cuI * np.dot(y, x)) * y
+        p = r.copy()
+        rs_old = np.dot(r, r)
+        for step in range(cg_steps):
+            if rs_old < 1e-20:  # Already converged
+                break
+            Ap = yTy_reg.dot(p)  # A.p = (yTy + lambda*I)p + yT(Cu-I)Yp, without forming yT(Cu-I)Y
+            for ptr in range(indptr[u], indptr[u + 1]):
+                y = Y[indices[ptr]]
+                Ap += alpha * data[ptr] * np.dot(y, p) * y
+            step_size = rs_old / np.dot(p, Ap)
+            x += step_size * p
+            r -= step_size * Ap
+            rs_new = np.dot(r, r)
+            p = r + (rs_new / rs_old) * p
+            rs_old = rs_new
+        # Approximately solves Xu = ((yTy + yT(Cu-I)Y + lambda*I)^-1)yTCuPu, equations 4 and 5 from the paper
+
+
+def implicit_weighted_ALS(training_set, lambda_val=0.1, alpha=40, iterations=10, rank_size=20, seed=0, cg_steps=3):
     '''
     Implicit weighted ALS taken from Hu, Koren, and Volinsky 2008. Designed for alternating least squares and implicit
     feedback based collaborative filtering.
@@ -127,74 +191,94 @@ def implicit_weighted_ALS(training_set, lambda_val=0.1, alpha=40, iterations=10,
 
     seed - Set the seed for reproducible results
 
+    cg_steps - The number of conjugate gradient steps each user/item vector takes per iteration, starting from its
+    value in the previous iteration. Default is 3.
+
     returns:
 
     The feature vectors for users and items. The dot product of these feature vectors should give you the expected
-    "rating" at each point in your original matrix.
+    "rating" at each point in your original matrix. Both are dense float32 ndarrays (m x rank and rank x n), since
+    the factors have no zeros worth storing sparsely.
     '''
 
-    # first set up our confidence matrix
-
-    conf = (alpha * training_set)  # To allow the matrix to stay sparse, I will add one later when each row is taken
-    # and converted to dense.
-    num_user = conf.shape[0]
-    num_item = conf.shape[1]  # Get the size of our original ratings matrix, m x n
+    # The confidence Cu = 1 + alpha*Ru is built from each row's stored ratings inside als_step, so no scaled copy
+    # of the ratings matrix is needed.
+    u_indptr, u_indices, u_data = training_set.indptr, training_set.indices, training_set.data  # csr arrays, one
+    # slice per user
+    training_set_csc = training_set.tocsc()  # Column compressed copy so every item is a contiguous slice as well
+    i_indptr, i_indices, i_data = training_set_csc.indptr, training_set_csc.indices, training_set_csc.data
+    num_user = training_set.shape[0]
+    num_item = training_set.shape[1]  # Get the size of our original ratings matrix, m x n
 
     # initialize our X/Y feature vectors randomly with a set seed
     rstate = np.random.RandomState(seed)
 
-    X = sparse.csr_matrix(rstate.normal(size=(num_user, rank_size)))  # Random numbers in a m x rank shape
-    Y = sparse.csr_matrix(rstate.normal(size=(num_item, rank_size)))  # Normally this would be rank x n but we can
-    # transpose at the end. Makes calculation more simple.
-    X_eye = sparse.eye(num_user)
-    Y_eye = sparse.eye(num_item)
-    lambda_eye = lambda_val * sparse.eye(rank_size)  # Our regularization term lambda*I.
+    X = (0.01 * rstate.normal(size=(num_user, rank_size))).astype(np.float32)  # Small random numbers in a dense
+    # m x rank array. They are the warm start for the conjugate gradient steps, so they need to start near zero
+    Y = (0.01 * rstate.normal(size=(num_item, rank_size))).astype(np.float32)  # Normally this would be rank x n but
+    # we can transpose at the end. Makes calculation more simple.
+    lambda_eye = lambda_val * np.eye(rank_size, dtype=np.float32)  # Our regularization term lambda*I.
 
     # We can compute this before iteration starts.
 
     # Begin iterations
 
     for iter_step in range(iterations):  # Iterate back and forth between solving X given fixed Y and vice versa
-        # Compute yTy and xTx at beginning of each iteration to save computing time
+        # Compute yTy once per half iteration to save computing time
         yTy = Y.T.dot(Y)
-        xTx = X.T.dot(X)
-        # Being iteration to solve for X based on fixed Y
-        for u in range(num_user):
-            conf_samp = conf[u, :].toarray()  # Grab user row from confidence matrix and convert to dense
-            pref = conf_samp.copy()
-            pref[pref != 0] = 1  # Create binarized preference vector
-            CuI = sparse.diags(conf_samp, [0])  # Get Cu - I term, which is just CuI since we never added 1
-            yTCuIY = Y.T.dot(CuI).dot(Y)  # This is the yT(Cu-I)Y term
-            yTCupu = Y.T.dot(CuI + Y_eye).dot(pref.T)  # This is the yTCuPu term, where we add the eye back in
-            # Cu - I + I = Cu
-            X[u] = spsolve(yTy + yTCuIY + lambda_eye, yTCupu)
-            # Solve for Xu = ((yTy + yT(Cu-I)Y + lambda*I)^-1)yTCuPu, equation 4 from the paper
-        # Begin iteration to solve for Y based on fixed X
-        for i in range(num_item):
-            conf_samp = conf[:, i].T.toarray()  # transpose to get it in row format and convert to dense
-            pref = conf_samp.copy()
-            pref[pref != 0] = 1  # Create binarized preference vector
-            CiI = sparse.diags(conf_samp, [0])  # Get Ci - I term, which is just CiI since we never added 1
-            xTCiIX = X.T.dot(CiI).dot(X)  # This is the xT(Cu-I)X term
-            xTCiPi = X.T.dot(CiI + X_eye).dot(pref.T)  # This is the xTCiPi term
-            Y[i] = spsolve(xTx + xTCiIX + lambda_eye, xTCiPi)
-            # Solve for Yi = ((xTx + xT(Cu-I)X) + lambda*I)^-1)xTCiPi, equation 5 from the paper
+        als_step(u_indptr, u_indices, u_data, Y, yTy + lambda_eye, alpha, cg_steps, X)  # Solve for X based on
+        # fixed Y
+        xTx = X.T.dot(X)  # Computed from the X that was just solved for, so the item step is consistent with it
+        als_step(i_indptr, i_indices, i_data, X, xTx + lambda_eye, alpha, cg_steps, Y)  # Then for Y based on fixed
+        # X, the csc arrays let items be handled exactly like users
     # End iterations
     return X, Y.T  # Transpose at the end to make up for not being transposed at the beginning.
-    # Y needs to be rank x n. Keep these as separate matrices for scale reasons.
+    # Y needs to be rank x n. The factors are dense, so hand them back as plain ndarrays.
+
+
+def implicit_library_ALS(training_set, lambda_val=0.1, alpha=40, iterations=10, rank_size=20, seed=0):
+    '''
+    The same Hu, Koren, and Volinsky 2008 model as implicit_weighted_ALS, but fitted with the Cython/OpenMP
+    implementation from the implicit library (conjugate gradient solver) instead of solving every row in Python.
+
+    parameters:
+
+    training_set - Our matrix of ratings with shape m x n, where m is the number of users and n is the number of items.
+    Should be a sparse csr matrix.
+
+    lambda_val, alpha, iterations, rank_size, seed - Same meaning as in implicit_weighted_ALS. The seed is only
+    honoured by implicit 0.5 and later, older versions have no way to set it.
+
+    returns:
+
+    The user feature vectors (m x rank) and item feature vectors (rank x n) as dense ndarrays.
+    '''
+    conf = (alpha * training_set).astype(np.float32)
+    conf.data += 1  # implicit takes the full confidence Cui = 1 + alpha*Rui on the observed entries
+    model_args = dict(factors=rank_size, regularization=lambda_val, iterations=iterations, use_cg=True,
+                      use_native=True, use_gpu=False)
+    major, minor = (int(part) for part in implicit.__version__.split('.')[:2])
+    if (major, minor) < (0, 5):
+        model = implicit.als.AlternatingLeastSquares(**model_args)
+        model.fit(conf.T.tocsr())  # Older versions of implicit expect an item x user matrix
+    else:
+        model = implicit.als.AlternatingLeastSquares(random_state=seed, **model_args)
+        model.fit(conf)
+    return np.asarray(model.user_factors), np.asarray(model.item_factors).T
 
 
 user_vecs, item_vecs = implicit_weighted_ALS(product_train, lambda_val = 0.1, alpha = 15, iterations =15,
                                             rank_size = 20)
 
-print(user_vecs[0,:].dot(item_vecs).toarray()[0,:5])
+print(user_vecs[0,:].dot(item_vecs)[:5])
 
 
 
 
 def auc_score(predictions, test):
     '''
-    This simple function will output the area under the curve using sklearn's metrics.
+    This simple function will output the area under the curve, computed from the ranks of the predictions with the
+    Mann-Whitney U statistic (the same value as sklearn's roc_curve + auc, without building the curve).
 
     parameters:
 
@@ -204,10 +288,16 @@ def auc_score(predictions, test):
 
     returns:
 
-    - AUC (area under the Receiver Operating Characterisic curve)
+    - AUC (area under the Receiver Operating Characterisic curve), or nan when test holds only one class and the AUC
+    is undefined
     '''
-    fpr, tpr, thresholds = metrics.roc_curve(test, predictions)
-    return metrics.auc(fpr, tpr)
+    pos = test != 0  # Items the user actually interacted with
+    n_pos = np.count_nonzero(pos)
+    n_neg = pos.size - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return np.nan  # Only one class present, the AUC is undefined
+    rank_sum = rankdata(predictions)[pos].sum()  # Ties get their average rank, just like ties in the ROC curve
+    return (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
 
 
 def calc_mean_auc(training_set, altered_users, predictions, test_set):
@@ -236,38 +326,46 @@ def calc_mean_auc(training_set, altered_users, predictions, test_set):
 
     store_auc = []  # An empty list to store the AUC for each user that had an item removed from the training set
     popularity_auc = []  # To store popular AUC scores
-    pop_items = np.array(test_set.sum(axis=0)).reshape(-1)  # Get sum of item iteractions to find most popular
-    item_vec = predictions[1]
-    for user in altered_users:  # Iterate through each user that had an item altered
-        training_row = training_set[user, :].toarray().reshape(-1)  # Get the training set row
+    pop_items = test_set.getnnz(axis=0)  # Get the number of users interacting with each item to find most popular
+    altered_users = np.asarray(altered_users)
+    user_vec, item_vec = predictions
+    pred_block = user_vec[altered_users].dot(item_vec.transpose())  # Predicted values for every altered user at
+    # once, one matrix product of shape (users x rank) . (rank x items)
+    training_block = training_set[altered_users].toarray()  # The matching training and test set rows
+    test_block = test_set[altered_users].toarray()
+    for training_row, pred_row, test_row in zip(training_block, pred_block, test_block):  # Iterate through each user
+        # that had an item altered
         zero_inds = np.where(training_row == 0)  # Find where the interaction had not yet occurred
-        # Get the predicted values based on our user/item vectors
-        user_vec = predictions[0][user, :]
-        pred = user_vec.dot(item_vec.transpose()).toarray()[0, zero_inds].reshape(-1)
+        pred = pred_row[zero_inds]
         # Get only the items that were originally zero
         # Select all ratings from the MF prediction for this user that originally had no iteraction
-        actual = test_set[user, :].toarray()[0, zero_inds].reshape(-1)
-        # Select the binarized yes/no interaction pairs from the original full data
+        actual = (test_row[zero_inds] != 0).astype(np.int8)
+        # Select the yes/no interaction pairs, binarized here, from the original full data
         # that align with the same pairs in training
         pop = pop_items[zero_inds]  # Get the item popularity for our chosen items
         store_auc.append(auc_score(pred, actual))  # Calculate AUC for the given user and store
         popularity_auc.append(auc_score(pop, actual))  # Calculate AUC using most popular and score
     # End users iteration
 
-    return float('%.3f' % np.mean(store_auc)), float('%.3f' % np.mean(popularity_auc))
+    return float('%.3f' % np.nanmean(store_auc)), float('%.3f' % np.nanmean(popularity_auc))
     # Return the mean AUC rounded to three decimal places for both test and popularity benchmark
 
-print(calc_mean_auc(product_train, product_users_altered,
-              [sparse.csr_matrix(user_vecs), sparse.csr_matrix(item_vecs.T)], product_test))
+print(calc_mean_auc(product_train, product_users_altered, [user_vecs, item_vecs.T], product_test))
 # AUC for our recommender system
 
+if compare_with_implicit:
+    # Deliberate side-by-side benchmark: fits the same model again with the implicit library and scores it, which
+    # costs a second fit and a second calc_mean_auc pass
+    lib_user_vecs, lib_item_vecs = implicit_library_ALS(product_train, lambda_val = 0.1, alpha = 15, iterations = 15,
+                                                        rank_size = 20)
+    print(calc_mean_auc(product_train, product_users_altered, [lib_user_vecs, lib_item_vecs.T], product_test))
+    # AUC for the same model fitted with the implicit library
+
 
 # Recommandation Example
-customers_arr = np.array(customers) # Array of customer IDs from the ratings matrix
-products_arr = np.array(products) # Array of product IDs from the ratings matrix
 
 
-def get_items_purchased(customer_id, mf_train, customers_list, products_list, item_lookup):
+def get_items_purchased(customer_id, mf_train, cust_to_idx, products_list, item_lookup):
     '''
     This just tells me which items have been already purchased by a specific user in the training set.
 
@@ -277,27 +375,27 @@ def get_items_purchased(customer_id, mf_train, customers_list, products_list, it
 
     mf_train - The initial ratings training set used (without weights applied)
 
-    customers_list - The array of customers used in the ratings matrix
+    cust_to_idx - A dict mapping each customer ID to its row in the ratings matrix
 
     products_list - The array of products used in the ratings matrix
 
-    item_lookup - A simple pandas dataframe of the unique product ID/product descriptions available
+    item_lookup - The pandas dataframe of product descriptions indexed by product ID (item_lookup_by_code)
 
     returns:
 
     A list of item IDs and item descriptions for a particular customer that were already purchased in the training set
     '''
-    cust_ind = np.where(customers_list == customer_id)[0][0]  # Returns the index row of our customer id
+    cust_ind = cust_to_idx[customer_id]  # Returns the index row of our customer id
     purchased_ind = mf_train[cust_ind, :].nonzero()[1]  # Get column indices of purchased items
     prod_codes = products_list[purchased_ind]  # Get the stock codes for our purchased items
-    return item_lookup.loc[item_lookup.StockCode.isin(prod_codes)]
+    return item_lookup.reindex(prod_codes.astype(str)).reset_index()
 
 # looking up top 5 customers
 print(customers_arr[:5])
 # get a specific customer and examine their purchase from the training set
-print(get_items_purchased(12346, product_train, customers_arr, products_arr, item_lookup))
+print(get_items_purchased(12346, product_train, cust_to_idx, products_arr, item_lookup_by_code))
 
-def rec_items(customer_id, mf_train, user_vecs, item_vecs, customer_list, item_list, item_lookup, num_items=10):
+def rec_items(customer_id, mf_train, user_vecs, item_vecs, cust_to_idx, item_list, item_lookup, num_items=10):
     '''
     This function will return the top recommended items to our users
 
@@ -311,13 +409,12 @@ def rec_items(customer_id, mf_train, user_vecs, item_vecs, customer_list, item_l
 
     item_vecs - the item vectors from your fitted matrix factorization
 
-    customer_list - an array of the customer's ID numbers that make up the rows of your ratings matrix
-                    (in order of matrix)
+    cust_to_idx - a dict mapping each customer's ID number to its row of your ratings matrix
 
     item_list - an array of the products that make up the columns of your ratings matrix
                     (in order of matrix)
 
-    item_lookup - A simple pandas dataframe of the unique product ID/product descriptions available
+    item_lookup - The pandas dataframe of product descriptions indexed by product ID (item_lookup_by_code)
 
     num_items - The number of items you want to recommend in order of best recommendations. Default is 10.
 
@@ -326,27 +423,21 @@ def rec_items(customer_id, mf_train, user_vecs, item_vecs, customer_list, item_l
     - The top n recommendations chosen based on the user/item vectors for items never interacted with/purchased
     '''
 
-    cust_ind = np.where(customer_list == customer_id)[0][0]  # Returns the index row of our customer id
+    cust_ind = cust_to_idx[customer_id]  # Returns the index row of our customer id
     pref_vec = mf_train[cust_ind, :].toarray()  # Get the ratings from the training set ratings matrix
     pref_vec = pref_vec.reshape(-1) + 1  # Add 1 to everything, so that items not purchased yet become equal to 1
     pref_vec[pref_vec > 1] = 0  # Make everything already purchased zero
     rec_vector = user_vecs[cust_ind, :].dot(item_vecs)  # Get dot product of user vector and all item vectors
-    # Scale this recommendation vector between 0 and 1
-    min_max = MinMaxScaler()
-    rec_vector_scaled = min_max.fit_transform(rec_vector.toarray().reshape(-1, 1))[:, 0]
-    recommend_vector = pref_vec * rec_vector_scaled
-    # Items already purchased have their recommendation multiplied by zero
-    product_idx = np.argsort(recommend_vector)[::-1][:num_items]  # Sort the indices of the items into order
+    recommend_vector = np.where(pref_vec > 0, rec_vector, -np.inf)
+    # Items already purchased can never be recommended. No scaling is needed, only the order of the scores matters
+    num_items = min(num_items, recommend_vector.size)  # Can't recommend more items than there are
+    top_idx = np.argpartition(-recommend_vector, num_items - 1)[:num_items]  # Find the best items without a full sort
+    product_idx = top_idx[np.argsort(-recommend_vector[top_idx])]  # Sort just those indices into order
     # of best recommendations
-    rec_list = []  # start empty list to store items
-    for index in product_idx:
-        code = item_list[index]
-        rec_list.append([code, item_lookup.Description.loc[item_lookup.StockCode == code].iloc[0]])
-        # Append our descriptions to the list
-    codes = [item[0] for item in rec_list]
-    descriptions = [item[1] for item in rec_list]
-    final_frame = pd.DataFrame({'StockCode': codes, 'Description': descriptions})  # Create a dataframe
-    return final_frame[['StockCode', 'Description']]  # Switch order of columns around
-
-print(rec_items(12346, product_train, user_vecs, item_vecs, customers_arr, products_arr, item_lookup,
+    codes = item_list[product_idx]  # Get the stock codes of our recommendations, in order
+    descriptions = item_lookup.Description.reindex(codes.astype(str), fill_value='').values  # Look up all of
+    # their descriptions at once
+    return pd.DataFrame({'StockCode': codes, 'Description': descriptions})  # Create a dataframe
+
+print(rec_items(12346, product_train, user_vecs, item_vecs, cust_to_idx, products_arr, item_lookup_by_code,
                        num_items =10))